@@ -1,123 +1,209 @@
-import os
-import json
+import time
+import asyncio
+from datetime import datetime
+from collections import OrderedDict
+
+import orjson
+import aiosqlite
+from cachetools import TTLCache
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 
-from config import GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REDIRECT_URI, GOOGLE_SCOPES, TOKEN_STORAGE_FILE
+from config import GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REDIRECT_URI, GOOGLE_SCOPES, TOKEN_DB_FILE
 from logger_config import logger
 
-# In-memory store for flow objects, mapping state to flow
-# For a deployed app, this might need a more persistent or shared store if using multiple workers
-active_flows = {}
+# In-memory store for pending OAuth flows, keyed by user_id (as str).
+# For a deployed app, this might need a more persistent or shared store if using multiple workers.
+# Bounded and TTL-expired: abandoned /login attempts would otherwise leak Flow
+# objects (each holding an HTTP session) for the lifetime of the process.
+MAX_ACTIVE_FLOWS = 10_000
+FLOW_TTL_SECONDS = 600  # Abandoned flows are reaped after 10 minutes
+active_flows = OrderedDict()  # str(user_id) -> {'flow', 'state', 'created_at'}
+_flows_lock = asyncio.Lock()
+_flow_reaper_task = None
 
-def get_google_auth_flow():
-    client_config = {
-        "web": {
-            "client_id": GOOGLE_CLIENT_ID,
-            "client_secret": GOOGLE_CLIENT_SECRET,
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "redirect_uris": [GOOGLE_REDIRECT_URI],
-        }
+# Parsed Credentials cached per user so burst traffic doesn't hit SQLite and
+# rebuild the object on every message. Entries live until shortly before the
+# access token expires (capped at 5 minutes) and are dropped on save/delete
+# or an explicit invalidation after a Drive auth failure. The TTLCache bounds
+# the table and evicts stale entries; the stored per-entry deadline enforces
+# the (possibly earlier) token-expiry cutoff.
+_CREDS_CACHE_MAX_TTL = 300.0
+_creds_cache = TTLCache(maxsize=10_000, ttl=_CREDS_CACHE_MAX_TTL)  # user_id -> (Credentials, monotonic deadline)
+
+def _cache_credentials(user_id: int, credentials):
+    ttl = _CREDS_CACHE_MAX_TTL
+    if credentials.expiry:
+        # google-auth expiry is a naive UTC datetime; stop serving the cached
+        # entry 60s before the token lapses so refresh happens in time.
+        remaining = (credentials.expiry - datetime.utcnow()).total_seconds() - 60
+        ttl = max(0.0, min(ttl, remaining))
+    _creds_cache[user_id] = (credentials, time.monotonic() + ttl)
+
+def invalidate_credentials_cache(user_id: int):
+    # Drop the cached entry, e.g. after Drive answers 401/403.
+    _creds_cache.pop(user_id, None)
+
+# One SQLite connection per process, created lazily. WAL mode means a save is
+# a single indexed UPSERT instead of rewriting a whole JSON file, and two
+# concurrent OAuth completions can no longer corrupt the store.
+_db = None
+_db_lock = asyncio.Lock()
+
+# Constant for the process lifetime (values come from env vars read at
+# import), so build it once instead of per /login.
+_CLIENT_CONFIG = {
+    "web": {
+        "client_id": GOOGLE_CLIENT_ID,
+        "client_secret": GOOGLE_CLIENT_SECRET,
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "redirect_uris": [GOOGLE_REDIRECT_URI],
     }
-    flow = Flow.from_client_config(
-        client_config,
+}
+
+def get_google_auth_flow():
+    # A fresh Flow per call is still required: authorization_url() mutates
+    # per-user state on the flow object.
+    return Flow.from_client_config(
+        _CLIENT_CONFIG,
         scopes=GOOGLE_SCOPES,
         redirect_uri=GOOGLE_REDIRECT_URI
     )
-    return flow
 
-def get_auth_url(user_id: int):
+async def get_auth_url(user_id: int):
     flow = get_google_auth_flow()
     authorization_url, state = flow.authorization_url(
         access_type='offline',
         prompt='consent' # Force consent to get a refresh token every time
     )
-    active_flows[str(user_id)] = {'flow': flow, 'state': state} # Store flow with user_id as key
+    async with _flows_lock:
+        active_flows[str(user_id)] = {'flow': flow, 'state': state, 'created_at': time.monotonic()}
+        active_flows.move_to_end(str(user_id)) # Re-login moves the user to the newest slot
+        while len(active_flows) > MAX_ACTIVE_FLOWS:
+            evicted_user, _ = active_flows.popitem(last=False) # Drop the oldest pending flow
+            logger.warning(f"Evicted oldest pending OAuth flow (user {evicted_user}); {MAX_ACTIVE_FLOWS} flow cap reached.")
     logger.info(f"Generated auth URL for user {user_id} with state {state}")
     return authorization_url
 
-def exchange_code_for_credentials(user_id: int, code: str):
-    user_flow_data = active_flows.get(str(user_id))
+async def exchange_code_for_credentials(user_id: int, code: str):
+    async with _flows_lock:
+        user_flow_data = active_flows.pop(str(user_id), None)
     if not user_flow_data:
         logger.error(f"No active OAuth flow found for user {user_id} to exchange code.")
         return None
-    
+
     flow = user_flow_data['flow']
     try:
-        flow.fetch_token(code=code)
+        # fetch_token is a blocking HTTPS round-trip to Google's token endpoint
+        await asyncio.to_thread(flow.fetch_token, code=code)
         credentials = flow.credentials
-        save_user_credentials(user_id, credentials)
-        if str(user_id) in active_flows: # Clean up after successful exchange
-            del active_flows[str(user_id)]
+        await save_user_credentials(user_id, credentials)
         return credentials
     except Exception as e:
         logger.error(f"Error exchanging code for user {user_id}: {e}")
-        if str(user_id) in active_flows:
-            del active_flows[str(user_id)]
         return None
 
-def save_user_credentials(user_id: int, credentials):
-    all_tokens = {}
-    if os.path.exists(TOKEN_STORAGE_FILE):
-        try:
-            with open(TOKEN_STORAGE_FILE, 'r') as f:
-                all_tokens = json.load(f)
-        except json.JSONDecodeError:
-            logger.warning(f"Token storage file {TOKEN_STORAGE_FILE} is corrupted. Starting fresh.")
-            all_tokens = {}
-
-    all_tokens[str(user_id)] = {
-        'token': credentials.token,
-        'refresh_token': credentials.refresh_token,
-        'token_uri': credentials.token_uri,
-        'client_id': credentials.client_id,
-        'client_secret': credentials.client_secret,
-        'scopes': credentials.scopes
-    }
-    with open(TOKEN_STORAGE_FILE, 'w') as f:
-        json.dump(all_tokens, f)
+async def _reap_flows():
+    # Background task: evict pending flows older than FLOW_TTL_SECONDS so
+    # abandoned /login attempts don't accumulate forever.
+    while True:
+        await asyncio.sleep(60)
+        cutoff = time.monotonic() - FLOW_TTL_SECONDS
+        async with _flows_lock:
+            stale = [uid for uid, data in active_flows.items() if data['created_at'] < cutoff]
+            for uid in stale:
+                del active_flows[uid]
+        if stale:
+            logger.info(f"Reaped {len(stale)} expired OAuth flow(s).")
+
+def start_flow_reaper():
+    # Schedule the reaper once; safe to call again after a restart of the loop.
+    global _flow_reaper_task
+    if _flow_reaper_task is None or _flow_reaper_task.done():
+        _flow_reaper_task = asyncio.create_task(_reap_flows())
+        logger.info("Started OAuth flow reaper task.")
+
+async def _get_db():
+    # Lazily open the one per-process connection and create the schema.
+    global _db
+    async with _db_lock:
+        if _db is None:
+            _db = await aiosqlite.connect(TOKEN_DB_FILE)
+            await _db.execute("PRAGMA journal_mode=WAL")
+            await _db.execute("PRAGMA synchronous=NORMAL")
+            await _db.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " user_id INTEGER PRIMARY KEY,"
+                " token TEXT,"
+                " refresh_token TEXT,"
+                " token_uri TEXT,"
+                " client_id TEXT,"
+                " client_secret TEXT,"
+                " scopes TEXT)"  # JSON-encoded list
+            )
+            await _db.commit()
+    return _db
+
+async def save_user_credentials(user_id: int, credentials):
+    db = await _get_db()
+    await db.execute(
+        "INSERT INTO users (user_id, token, refresh_token, token_uri, client_id, client_secret, scopes)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT(user_id) DO UPDATE SET"
+        " token=excluded.token, refresh_token=excluded.refresh_token, token_uri=excluded.token_uri,"
+        " client_id=excluded.client_id, client_secret=excluded.client_secret, scopes=excluded.scopes",
+        (user_id, credentials.token, credentials.refresh_token, credentials.token_uri,
+         credentials.client_id, credentials.client_secret, orjson.dumps(credentials.scopes))
+    )
+    await db.commit()
+    _cache_credentials(user_id, credentials)
     logger.info(f"Saved credentials for user {user_id}")
 
-def load_user_credentials(user_id: int):
-    if not os.path.exists(TOKEN_STORAGE_FILE):
-        return None
-    try:
-        with open(TOKEN_STORAGE_FILE, 'r') as f:
-            all_tokens = json.load(f)
-    except json.JSONDecodeError:
-        logger.error(f"Could not decode tokens from {TOKEN_STORAGE_FILE}")
-        return None
+async def load_user_credentials(user_id: int):
+    cached = _creds_cache.get(user_id)
+    if cached and time.monotonic() < cached[1]:
+        return cached[0]
 
-    user_creds_dict = all_tokens.get(str(user_id))
-    if not user_creds_dict:
+    db = await _get_db()
+    async with db.execute(
+        "SELECT token, refresh_token, token_uri, client_id, client_secret, scopes"
+        " FROM users WHERE user_id=?", (user_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if not row:
         return None
 
-    credentials = Credentials(**user_creds_dict)
-    # Refresh token if expired
+    token, refresh_token, token_uri, client_id, client_secret, scopes = row
+    credentials = Credentials(
+        token=token,
+        refresh_token=refresh_token,
+        token_uri=token_uri,
+        client_id=client_id,
+        client_secret=client_secret,
+        scopes=orjson.loads(scopes) if scopes else None
+    )
+    # Refresh token if expired; refresh() is a blocking HTTPS round-trip
     if credentials and credentials.expired and credentials.refresh_token:
         try:
-            credentials.refresh(Request())
-            save_user_credentials(user_id, credentials) # Save refreshed credentials
+            await asyncio.to_thread(credentials.refresh, Request())
+            await save_user_credentials(user_id, credentials) # Save refreshed credentials
             logger.info(f"Refreshed credentials for user {user_id}")
         except Exception as e:
             logger.error(f"Failed to refresh credentials for user {user_id}: {e}")
             # Potentially delete invalid credentials or notify user
-            delete_user_credentials(user_id)
+            await delete_user_credentials(user_id)
             return None
+    _cache_credentials(user_id, credentials)
     return credentials
 
-def delete_user_credentials(user_id: int):
-    all_tokens = {}
-    if os.path.exists(TOKEN_STORAGE_FILE):
-        with open(TOKEN_STORAGE_FILE, 'r') as f:
-            all_tokens = json.load(f)
-    
-    if str(user_id) in all_tokens:
-        del all_tokens[str(user_id)]
-        with open(TOKEN_STORAGE_FILE, 'w') as f:
-            json.dump(all_tokens, f)
+async def delete_user_credentials(user_id: int):
+    invalidate_credentials_cache(user_id)
+    db = await _get_db()
+    cursor = await db.execute("DELETE FROM users WHERE user_id=?", (user_id,))
+    await db.commit()
+    if cursor.rowcount > 0:
         logger.info(f"Deleted credentials for user {user_id}")
         return True
     return False
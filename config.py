@@ -13,6 +13,35 @@ ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", 0)) # Default to 0 if not set
 LARGE_FILE_THRESHOLD_MB = int(os.getenv("LARGE_FILE_THRESHOLD_MB", 50))
 LARGE_FILE_THRESHOLD_BYTES = LARGE_FILE_THRESHOLD_MB * 1024 * 1024
 MAX_FILE_SIZE_TG_BYTES = int(os.getenv("MAX_FILE_SIZE_TG_MB", 2000)) * 1024 * 1024
+# Files up to this size are streamed Drive -> Telegram through memory with no
+# disk staging; larger files fall back to staging in DOWNLOAD_DIR.
+STREAM_MAX_BYTES = int(os.getenv("STREAM_MAX_MB", 200)) * 1024 * 1024
+
+# Concurrency caps for the transfer legs, so parallel processing can't
+# over-commit RAM, disk, or sockets
+MAX_PARALLEL_DOWNLOADS = int(os.getenv("MAX_PARALLEL_DOWNLOADS", 4))
+MAX_PARALLEL_UPLOADS = int(os.getenv("MAX_PARALLEL_UPLOADS", 2))
+# How many of one request's files are processed at once
+MAX_PARALLEL_FILES = int(os.getenv("MAX_PARALLEL_FILES", 3))
+
+# Staged-download guards: hard per-file size cap, free disk space that must
+# remain after a download completes, and a whole-download deadline so a
+# stalled Drive stream can't pin a download slot forever.
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_MB", 4000)) * 1024 * 1024
+DISK_SAFETY_MARGIN_BYTES = int(os.getenv("DISK_SAFETY_MARGIN_MB", 512)) * 1024 * 1024
+DOWNLOAD_TIMEOUT_S = int(os.getenv("DOWNLOAD_TIMEOUT_S", 1800))
+
+# Optional self-hosted telegram-bot-api server (e.g. "http://localhost:8081").
+# Lifts the 50 MB upload cap to 2 GB and lets uploads pass a local file path
+# instead of re-streaming bytes over HTTP. Leave unset to use api.telegram.org.
+LOCAL_BOT_API_URL = os.getenv("LOCAL_BOT_API_URL")
+
+# Webhook mode: set WEBHOOK_URL to the public https base of this host (e.g.
+# "https://mybot.example.com") to receive updates pushed by Telegram instead
+# of long-polling for them. Leave unset to keep polling (fine for dev/Colab).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Optional X-Telegram-Bot-Api-Secret-Token check
 
 # Google OAuth Scopes
 GOOGLE_SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
@@ -22,5 +51,5 @@ DOWNLOAD_DIR = "downloads"
 if not os.path.exists(DOWNLOAD_DIR):
     os.makedirs(DOWNLOAD_DIR)
 
-# Simple file-based token storage (for demonstration; use a proper DB in production)
-TOKEN_STORAGE_FILE = "user_tokens.json"
+# SQLite-backed token storage; WAL mode keeps per-user updates O(1) and crash-safe
+TOKEN_DB_FILE = "tokens.db"
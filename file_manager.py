@@ -1,81 +1,296 @@
 import os
 import io
-import time
+import asyncio
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+import aiohttp
+import aiofiles
 from googleapiclient.http import MediaIoBaseDownload
 from googleapiclient.errors import HttpError
-from telegram import InputFile
+from google.auth.transport.requests import Request
+from telegram import InputMediaDocument
 
 from logger_config import logger
-from config import DOWNLOAD_DIR, MAX_FILE_SIZE_TG_BYTES
+from pathlib import Path
+
+from config import DOWNLOAD_DIR, MAX_FILE_SIZE_TG_BYTES, MAX_PARALLEL_DOWNLOADS, MAX_PARALLEL_UPLOADS, DOWNLOAD_TIMEOUT_S, LOCAL_BOT_API_URL
 from gdrive_handler import get_drive_service # To get service with credentials
 
+# Process-wide caps on concurrent transfer legs. However callers fan out,
+# at most this many downloads/uploads are in flight at once.
+DOWNLOAD_SEM = asyncio.Semaphore(MAX_PARALLEL_DOWNLOADS)
+UPLOAD_SEM = asyncio.Semaphore(MAX_PARALLEL_UPLOADS)
+
+_DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+_DRIVE_EXPORT_URL = "https://www.googleapis.com/drive/v3/files/{file_id}/export"
+
+# One keep-alive HTTP session for all Drive media downloads, created lazily
+# inside the running event loop.
+_http_session = None
+
+async def _get_http_session():
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        # No total deadline: aiohttp's default ClientTimeout(total=300) would
+        # kill any download longer than 5 minutes mid-stream. Stall detection
+        # comes from sock_read; the whole-download budget is DOWNLOAD_TIMEOUT_S.
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=60))
+    return _http_session
+
+async def _stat_size(path):
+    # os.stat off the event loop; returns None if the file is missing.
+    try:
+        return (await asyncio.to_thread(os.stat, path)).st_size
+    except FileNotFoundError:
+        return None
+
+async def _remove_file(path):
+    # Best-effort unlink off the event loop.
+    try:
+        await asyncio.to_thread(os.remove, path)
+    except FileNotFoundError:
+        pass
+
 # Helper to format size
+_SIZE_LABELS = ('', 'K', 'M', 'G', 'T')
+
 def format_bytes(size):
-    if size is None: return "0 B"
-    # 2**10 = 1024
-    power = 2**10
-    n = 0
-    power_labels = {0 : '', 1: 'K', 2: 'M', 3: 'G', 4: 'T'}
-    while size > power:
-        size /= power
-        n += 1
-    return f"{size:.2f} {power_labels[n]}B"
-
-
-async def download_gdrive_file(file_id: str, file_name: str, file_size: int, credentials, progress_callback=None):
+    if not size: return "0 B"
+    # Pick the unit straight from the bit length (1024 = 2**10 per step)
+    # instead of repeated division; constant-time for any input.
+    n = min((int(size).bit_length() - 1) // 10, 4)
+    return f"{size / (1 << (10 * n)):.2f} {_SIZE_LABELS[n]}B"
+
+
+async def iter_gdrive_chunks(file_id: str, file_name: str, file_size: int, credentials, progress_callback=None, chunk_size=1024*1024, export_mime=None):
+    # Async generator yielding the file's bytes in chunks, so callers can
+    # consume a download without ever staging the whole file anywhere.
+    # With user credentials this is a single authenticated alt=media GET
+    # streamed natively in the event loop — one keep-alive response instead of
+    # a blocking per-chunk request through googleapiclient's state machine.
+    if credentials is None:
+        # No bearer token to send; fall back to the API client downloader.
+        async for chunk in _iter_chunks_via_api(file_id, file_name, file_size, credentials, progress_callback, chunk_size, export_mime):
+            yield chunk
+        return
+
+    if credentials.expired and credentials.refresh_token:
+        await asyncio.to_thread(credentials.refresh, Request())
+
+    session = await _get_http_session()
+    if export_mime: # Google Workspace docs go through the export endpoint
+        url = _DRIVE_EXPORT_URL.format(file_id=file_id)
+        params = {'mimeType': export_mime}
+    else:
+        url = _DRIVE_MEDIA_URL.format(file_id=file_id)
+        params = None
+    headers = {'Authorization': f'Bearer {credentials.token}'}
+    received = 0
+    downloaded_percentage = 0
+    # Throttle on the event loop's monotonic clock: one comparison per chunk,
+    # no gettimeofday syscalls, and immune to wall-clock jumps.
+    loop = asyncio.get_running_loop()
+    last_reported = loop.time()
+
+    async with session.get(url, headers=headers, params=params) as resp:
+        if resp.status != 200:
+            body = (await resp.text())[:200]
+            raise ConnectionError(f"Google Drive API error: {resp.status} - {body}")
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            received += len(chunk)
+            if progress_callback and file_size:
+                now = loop.time()
+                if now - last_reported >= 2.0:
+                    downloaded_percentage = min(int(received * 100 / file_size), 100)
+                    await progress_callback(file_name, downloaded_percentage, file_size)
+                    last_reported = now
+            yield chunk
+
+    if progress_callback: # Final progress
+        await progress_callback(file_name, 100, file_size, is_final=True)
+
+
+async def _iter_chunks_via_api(file_id: str, file_name: str, file_size: int, credentials, progress_callback=None, chunk_size=1024*1024*5, export_mime=None):
+    # googleapiclient-based chunk iterator, kept for credential-less access.
     service = get_drive_service(credentials)
-    file_path = os.path.join(DOWNLOAD_DIR, file_name) # Use original name for saving
+    if export_mime:
+        request = service.files().export_media(fileId=file_id, mimeType=export_mime)
+    else:
+        request = service.files().get_media(fileId=file_id)
+    buffer = io.BytesIO()
+    downloader = MediaIoBaseDownload(buffer, request, chunksize=chunk_size)
+    done = False
+    loop = asyncio.get_running_loop()
+    last_reported = loop.time()
+
+    while not done:
+        # next_chunk is a blocking HTTPS call; run it off the event loop
+        status, done = await asyncio.to_thread(downloader.next_chunk)
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        if status and progress_callback:
+            now = loop.time()
+            if now - last_reported >= 2.0:
+                await progress_callback(file_name, int(status.progress() * 100), file_size)
+                last_reported = now
+        if chunk:
+            yield chunk
+
+    if progress_callback: # Final progress
+        await progress_callback(file_name, 100, file_size, is_final=True)
 
-    # Ensure filename is safe for the filesystem
+
+async def stream_gdrive_to_telegram(bot, chat_id: int, file_id: str, file_name: str, file_size: int, credentials, caption: str, download_progress=None, upload_progress=None, export_mime=None):
+    # Fused download->upload path: chunks go from Drive straight into the
+    # Telegram upload body, skipping the write+read through DOWNLOAD_DIR.
+    # python-telegram-bot buffers outgoing documents in memory, so callers
+    # should only use this for files up to STREAM_MAX_BYTES and fall back to
+    # download_gdrive_file/upload_to_telegram beyond that.
+    if file_size > MAX_FILE_SIZE_TG_BYTES:
+        logger.warning(f"File {file_name} ({format_bytes(file_size)}) exceeds Telegram's limit of {format_bytes(MAX_FILE_SIZE_TG_BYTES)}. Skipping.")
+        await bot.send_message(chat_id, f"⚠️ File '{file_name}' ({format_bytes(file_size)}) is too large for Telegram (max {format_bytes(MAX_FILE_SIZE_TG_BYTES)}) and was skipped.")
+        return False
+
+    logger.info(f"Streaming {file_name} (ID: {file_id}, {format_bytes(file_size)}) directly to chat {chat_id}")
+
+    # python-telegram-bot buffers the whole document before sending, so the
+    # upload can only start once the download has finished; the win of this
+    # path is skipping the disk round-trip, not overlapping the two legs.
+    # The upload slot is acquired before the buffer fills: a filled buffer
+    # otherwise sits resident while its task queues on UPLOAD_SEM, letting
+    # in-memory bytes grow with the number of active chats instead of being
+    # capped at MAX_PARALLEL_UPLOADS x STREAM_MAX_BYTES.
+    async with UPLOAD_SEM:
+        buffer = io.BytesIO()
+        try:
+            async with DOWNLOAD_SEM:
+                async for chunk in iter_gdrive_chunks(file_id, file_name, file_size, credentials, download_progress, export_mime=export_mime):
+                    buffer.write(chunk)
+        except HttpError as error:
+            logger.error(f"An API error occurred while streaming {file_name}: {error}")
+            raise ConnectionError(f"Google Drive API error: {error.resp.status} - {error.details}") from error
+        except aiohttp.ClientError as error:
+            logger.error(f"A connection error occurred while streaming {file_name}: {error}")
+            raise ConnectionError(f"Google Drive download error: {error}") from error
+
+        buffer.seek(0)
+        try:
+            if upload_progress:
+                await upload_progress(file_name, 0, file_size)
+            await bot.send_document(chat_id=chat_id, document=buffer, filename=file_name, caption=caption, connect_timeout=60, read_timeout=120)
+            if upload_progress:
+                await upload_progress(file_name, 100, file_size, is_final=True)
+            logger.info(f"Successfully streamed {file_name} to chat {chat_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to upload streamed {file_name} to Telegram: {e}")
+            await bot.send_message(chat_id, f"❌ Failed to upload '{file_name}': {e}")
+            return False
+
+
+# sendMediaGroup limits: at most 10 documents per album, and each document
+# must fit the public API's 50 MB upload cap.
+ALBUM_MAX_FILES = 10
+ALBUM_MAX_FILE_BYTES = 50 * 1024 * 1024
+
+async def send_album_from_gdrive(bot, chat_id: int, batch, credentials):
+    # One sendMediaGroup call for up to ALBUM_MAX_FILES small files: a single
+    # HTTP round-trip and one rate-limit token instead of one per file.
+    # Per-file captions survive; batch entries are file_info dicts. Members
+    # are staged to disk and only read into the request body once an upload
+    # slot is held, so retained album bytes are bounded by
+    # MAX_PARALLEL_UPLOADS rather than by every album in flight.
+    logger.info(f"Sending album of {len(batch)} file(s) to chat {chat_id}")
+    staged = await asyncio.gather(*(
+        download_gdrive_file(f['id'], f['name'], f['size'], credentials, export_mime=f.get('export_mime'))
+        for f in batch
+    ), return_exceptions=True)
+    try:
+        for result in staged:
+            if isinstance(result, BaseException): # Any failed member fails the album
+                raise result
+        async with UPLOAD_SEM:
+            media = []
+            for f, path in zip(batch, staged):
+                data = await asyncio.to_thread(Path(path).read_bytes)
+                media.append(InputMediaDocument(media=data, filename=f['name'], caption=f"{f['path']} ({format_bytes(f['size'])})"))
+            await bot.send_media_group(chat_id=chat_id, media=media, connect_timeout=60, read_timeout=300)
+        logger.info(f"Successfully sent album of {len(batch)} file(s) to chat {chat_id}")
+    finally:
+        for result in staged:
+            if isinstance(result, str):
+                await _remove_file(result)
+
+
+async def download_gdrive_file(file_id: str, file_name: str, file_size: int, credentials, progress_callback=None, export_mime=None):
+    # Ensure filename is safe for the filesystem before building the path
     safe_file_name = "".join(c if c.isalnum() or c in ('.', '_', '-') else '_' for c in file_name)
     if not safe_file_name: # Handle cases where name becomes empty
         safe_file_name = file_id # Use file_id as a fallback
-    file_path = os.path.join(DOWNLOAD_DIR, safe_file_name)
-
+    # Unique per-transfer path: sanitized names can collide (duplicate
+    # basenames across a folder tree, two chats fetching the same file), and
+    # with transfers running concurrently and staged files unlinked on exit,
+    # a shared path would mean interleaved writers and racing cleanups.
+    file_path = os.path.join(DOWNLOAD_DIR, f"{uuid4().hex}_{safe_file_name}")
 
     logger.info(f"Starting download for: {file_name} (ID: {file_id}) to {file_path}. Size: {format_bytes(file_size)}")
-    
-    request = service.files().get_media(fileId=file_id)
-    
-    # Check if file already exists and is complete (simple check, can be improved)
-    if os.path.exists(file_path) and os.path.getsize(file_path) == file_size and file_size > 0:
-        logger.info(f"File {file_name} already exists and seems complete. Skipping download.")
-        return file_path
+
+    async def _write_out():
+        # aiofiles keeps the disk writes off the event loop thread, so other
+        # users' handlers keep running while a large file is being staged.
+        async with aiofiles.open(file_path, 'wb') as fh:
+            async for chunk in iter_gdrive_chunks(file_id, file_name, file_size, credentials, progress_callback, export_mime=export_mime):
+                await fh.write(chunk)
 
     try:
-        with io.FileIO(file_path, 'wb') as fh:
-            downloader = MediaIoBaseDownload(fh, request, chunksize=1024*1024*5) # 5MB chunks
-            done = False
-            downloaded_percentage = 0
-            last_reported_time = time.time()
-
-            while not done:
-                status, done = downloader.next_chunk()
-                if status:
-                    current_progress = int(status.progress() * 100)
-                    if current_progress > downloaded_percentage: # Report if changed
-                        downloaded_percentage = current_progress
-                        # Throttle progress updates (e.g., every 2 seconds or 5% change)
-                        if progress_callback and (time.time() - last_reported_time > 2 or downloaded_percentage % 5 == 0):
-                            await progress_callback(file_name, downloaded_percentage, file_size)
-                            last_reported_time = time.time()
-            
-            if progress_callback: # Final progress
-                 await progress_callback(file_name, 100, file_size, is_final=True)
-            logger.info(f"Successfully downloaded {file_name} to {file_path}")
-            return file_path
+        async with DOWNLOAD_SEM:
+            # Whole-download deadline: a stalled Drive stream gets cancelled
+            # instead of holding a download slot indefinitely.
+            await asyncio.wait_for(_write_out(), timeout=DOWNLOAD_TIMEOUT_S)
+        logger.info(f"Successfully downloaded {file_name} to {file_path}")
+        return file_path
+    except asyncio.TimeoutError:
+        logger.error(f"Download of {file_name} timed out after {DOWNLOAD_TIMEOUT_S}s")
+        await _remove_file(file_path) # Clean up partial download
+        raise ConnectionError(f"Download of '{file_name}' timed out after {DOWNLOAD_TIMEOUT_S}s")
     except HttpError as error:
         logger.error(f"An API error occurred during download of {file_name}: {error}")
-        if os.path.exists(file_path): os.remove(file_path) # Clean up partial download
+        await _remove_file(file_path) # Clean up partial download
         raise ConnectionError(f"Google Drive API error: {error.resp.status} - {error.details}") from error
+    except (aiohttp.ClientError, ConnectionError) as error:
+        logger.error(f"A connection error occurred during download of {file_name}: {error}")
+        await _remove_file(file_path) # Clean up partial download
+        raise ConnectionError(f"Google Drive download error: {error}") from error
     except Exception as e:
         logger.error(f"An unexpected error occurred during download of {file_name}: {e}")
-        if os.path.exists(file_path): os.remove(file_path) # Clean up
+        await _remove_file(file_path) # Clean up
         raise IOError(f"File system or download error: {e}") from e
 
 
+@asynccontextmanager
+async def staged_download(file_id: str, file_name: str, file_size: int, credentials, progress_callback=None, export_mime=None):
+    # Owns the lifetime of a staged download: yields the on-disk path and
+    # guarantees the file is removed however the block exits - success,
+    # exception, or cancellation - so staged files can't pile up in
+    # DOWNLOAD_DIR.
+    file_path = await download_gdrive_file(file_id, file_name, file_size, credentials, progress_callback, export_mime=export_mime)
+    try:
+        yield file_path
+    finally:
+        try:
+            await _remove_file(file_path)
+            logger.info(f"Cleaned up temporary file: {file_path}")
+        except Exception as e:
+            logger.error(f"Error cleaning up file {file_path}: {e}")
+
+
 async def upload_to_telegram(bot, chat_id: int, file_path: str, caption: str, original_filename: str, progress_callback_telegram=None):
-    file_size = os.path.getsize(file_path)
+    file_size = await _stat_size(file_path)
+    if file_size is None:
+        raise IOError(f"Staged file vanished before upload: {file_path}")
     logger.info(f"Starting upload of {original_filename} ({format_bytes(file_size)}) to chat {chat_id}")
 
     if file_size > MAX_FILE_SIZE_TG_BYTES:
@@ -84,11 +299,7 @@ async def upload_to_telegram(bot, chat_id: int, file_path: str, caption: str, or
         return False
 
     try:
-        with open(file_path, 'rb') as f:
-            # For very large files, you might need to use `InputFile` with streaming if supported well,
-            # or ensure your bot has enough memory. `python-telegram-bot` handles this reasonably.
-            # The `filename` argument in `send_document` ensures the original name is used in Telegram.
-            
+        async with UPLOAD_SEM:
             # Note: python-telegram-bot's progress for uploads is not straightforward to implement
             # for send_document directly. It's more of a "send and wait".
             # For true progress, one might need to use lower-level HTTP requests,
@@ -96,21 +307,27 @@ async def upload_to_telegram(bot, chat_id: int, file_path: str, caption: str, or
             if progress_callback_telegram:
                 await progress_callback_telegram(original_filename, 0, file_size) # 0% before sending
 
-            await bot.send_document(chat_id=chat_id, document=f, filename=original_filename, caption=caption, connect_timeout=60, read_timeout=120) # Increased timeouts
-            
+            if LOCAL_BOT_API_URL:
+                # Local Bot API server: pass the path itself so the server
+                # reads the file off disk instead of us re-streaming it.
+                await bot.send_document(chat_id=chat_id, document=Path(file_path), filename=original_filename, caption=caption, connect_timeout=60, read_timeout=120)
+            else:
+                # python-telegram-bot buffers file objects fully into the
+                # request body anyway, so read the staged file in a worker
+                # thread and hand over bytes — the disk read no longer blocks
+                # the event loop.
+                # The `filename` argument ensures the original name is used in Telegram.
+                data = await asyncio.to_thread(Path(file_path).read_bytes)
+                await bot.send_document(chat_id=chat_id, document=data, filename=original_filename, caption=caption, connect_timeout=60, read_timeout=120) # Increased timeouts
+
             if progress_callback_telegram:
                 await progress_callback_telegram(original_filename, 100, file_size, is_final=True) # 100% after sending
-            
+
             logger.info(f"Successfully uploaded {original_filename} to chat {chat_id}")
         return True
     except Exception as e: # Catch more specific Telegram errors if possible
         logger.error(f"Failed to upload {original_filename} to Telegram: {e}")
         await bot.send_message(chat_id, f"❌ Failed to upload '{original_filename}': {e}")
         return False
-    finally:
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                logger.info(f"Cleaned up temporary file: {file_path}")
-            except Exception as e:
-                logger.error(f"Error cleaning up file {file_path}: {e}")
+    # Cleanup is owned by the staged_download context manager, so the file is
+    # removed even on paths that never reach this function.
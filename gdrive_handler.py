@@ -1,13 +1,58 @@
 import re
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+import google_auth_httplib2
+from cachetools import TTLCache
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.oauth2.credentials import Credentials # For type hinting
 
 from logger_config import logger
 
+# googleapiclient calls are blocking HTTP; run them here so the event loop
+# stays free to serve other users while a request is in flight.
+_gdrive_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="gdrive")
+
+_thread_local = threading.local()
+
+def _authorized_http(credentials):
+    # httplib2.Http is not thread-safe, and every request built from a cached
+    # service would otherwise share the service's single transport. Keep one
+    # Http per executor thread and wrap it in a fresh AuthorizedHttp (cheap)
+    # so concurrent execute() calls never touch the same connection pool.
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        http = _thread_local.http = httplib2.Http()
+    if credentials is None:
+        return http
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+
+async def _aexec(request, credentials=None):
+    # Execute a googleapiclient HttpRequest off the event loop, on the
+    # executing thread's own transport rather than the shared service one.
+    def _run():
+        return request.execute(http=_authorized_http(credentials))
+    return await asyncio.get_running_loop().run_in_executor(_gdrive_executor, _run)
+
+# Built services cached per access token: rebuilding one parses the discovery
+# document and sets up a fresh HTTP client every time, which is pure overhead
+# when the same user sends several links. Keying by the token string means a
+# credential refresh naturally maps to a fresh entry, and the TTL (matching
+# auth_manager's credential-cache cap) keeps the cache from outliving tokens.
+_service_cache = TTLCache(maxsize=1000, ttl=300)  # access token -> Resource
+
 def get_drive_service(credentials: Credentials = None):
     if credentials:
-        return build('drive', 'v3', credentials=credentials, static_discovery=False)
+        service = _service_cache.get(credentials.token)
+        if service is None:
+            # static_discovery=True uses the discovery doc bundled with the
+            # client library, so no network fetch at all.
+            service = build('drive', 'v3', credentials=credentials, cache_discovery=False, static_discovery=True)
+            _service_cache[credentials.token] = service
+        return service
     else:
         # For public files, an API key might be used if preferred,
         # but for direct downloads, it often doesn't require explicit API key in `build`
@@ -23,13 +68,17 @@ def get_drive_service(credentials: Credentials = None):
         return build('drive', 'v3', developerKey="YOUR_API_KEY_IF_NEEDED_FOR_PUBLIC_ACCESS")
 
 
+# Compiled once at import; get_file_id_from_link runs for every inbound link
+_FILE_RE = re.compile(r'(?:/file/d/|id=)([a-zA-Z0-9_-]+)')
+_FOLDER_RE = re.compile(r'(?:/drive/folders/|folders/)([a-zA-Z0-9_-]+)')
+
 def get_file_id_from_link(drive_link: str):
-    # Regex to find file ID from various GDrive link formats
-    match = re.search(r'(?:/file/d/|id=)([a-zA-Z0-9_-]+)', drive_link)
+    # Find file ID from various GDrive link formats
+    match = _FILE_RE.search(drive_link)
     if match:
         return match.group(1)
-    # Regex for folder ID
-    match = re.search(r'(?:/drive/folders/|folders/)([a-zA-Z0-9_-]+)', drive_link)
+    # Folder ID
+    match = _FOLDER_RE.search(drive_link)
     if match:
         return match.group(1) # Returns ID, need to check if it's a folder or file
     return None
@@ -37,7 +86,7 @@ def get_file_id_from_link(drive_link: str):
 async def get_file_metadata(file_id: str, credentials: Credentials = None):
     try:
         service = get_drive_service(credentials)
-        file_metadata = service.files().get(fileId=file_id, fields="id, name, mimeType, size, webViewLink, parents").execute()
+        file_metadata = await _aexec(service.files().get(fileId=file_id, fields="id, name, mimeType, size, webViewLink, parents"), credentials)
         return file_metadata
     except HttpError as error:
         logger.error(f"An API error occurred while fetching metadata for {file_id}: {error}")
@@ -52,42 +101,77 @@ async def get_file_metadata(file_id: str, credentials: Credentials = None):
         return None
 
 
+# Cap on concurrent Drive list calls during a folder walk, so wide trees fan
+# out in parallel without hammering the API (or our thread pool).
+_LIST_SEM = asyncio.Semaphore(8)
+# Sibling folders listed per files.list call via OR'd "in parents" clauses;
+# keeps the q= string well under the API's query-length limit.
+_PARENTS_PER_QUERY = 10
+
+async def _list_children(service, credentials, parent_ids):
+    # One paginated files.list covering a whole group of parent folders.
+    q = " or ".join(f"'{fid}' in parents" for fid in parent_ids)
+    if len(parent_ids) > 1:
+        q = f"({q})"
+    items = []
+    page_token = None
+    while True:
+        async with _LIST_SEM:
+            response = await _aexec(service.files().list(
+                q=f"{q} and trashed=false",
+                spaces='drive',
+                fields='nextPageToken, files(id, name, mimeType, size, parents)',
+                pageToken=page_token,
+                pageSize=1000 # Drive API max; default of 100 costs 10x the round-trips
+            ), credentials)
+        items.extend(response.get('files', []))
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            return items
+
 async def list_files_in_folder_recursive(folder_id: str, credentials: Credentials, current_path=""):
+    # Breadth-first walk: every level of the tree is fetched with
+    # ceil(folders / _PARENTS_PER_QUERY) list calls instead of one call per
+    # folder, so total round-trips scale with depth and page count rather
+    # than with the number of directories.
     service = get_drive_service(credentials)
     files_and_folders = []
-    page_token = None
+    frontier = {folder_id: current_path} # folder_id -> path prefix
 
     try:
-        while True:
-            response = service.files().list(
-                q=f"'{folder_id}' in parents and trashed=false",
-                spaces='drive',
-                fields='nextPageToken, files(id, name, mimeType, size)',
-                pageToken=page_token,
-                orderBy='folder,name' # Ensures folders come first, then sorted by name
-            ).execute()
-
-            for item in response.get('files', []):
-                item_path = f"{current_path}/{item['name']}" if current_path else item['name']
-                item_details = {
-                    'id': item['id'],
-                    'name': item['name'],
-                    'mimeType': item['mimeType'],
-                    'size': int(item.get('size', 0)), # Size might be absent for Google Docs type files
-                    'path': item_path,
-                    'is_folder': item['mimeType'] == 'application/vnd.google-apps.folder'
-                }
-                files_and_folders.append(item_details)
-
-                if item_details['is_folder']:
-                    # Recursively list files in this subfolder
-                    logger.info(f"Entering subfolder: {item_details['path']}")
-                    sub_items = await list_files_in_folder_recursive(item['id'], credentials, item_details['path'])
-                    files_and_folders.extend(sub_items)
-            
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
+        while frontier:
+            parent_ids = list(frontier)
+            groups = [parent_ids[i:i + _PARENTS_PER_QUERY]
+                      for i in range(0, len(parent_ids), _PARENTS_PER_QUERY)]
+            level_results = await asyncio.gather(*(
+                _list_children(service, credentials, group) for group in groups
+            ))
+            next_frontier = {}
+            for items in level_results:
+                for item in items:
+                    # Map the child back to whichever frontier folder it came
+                    # from; shared files can carry parents outside the walk.
+                    parent_path = next(
+                        (frontier[pid] for pid in item.get('parents', []) if pid in frontier),
+                        None)
+                    if parent_path is None:
+                        continue
+                    item_path = f"{parent_path}/{item['name']}" if parent_path else item['name']
+                    item_details = {
+                        'id': item['id'],
+                        'name': item['name'],
+                        'mimeType': item['mimeType'],
+                        'size': int(item.get('size', 0)), # Size might be absent for Google Docs type files
+                        'path': item_path,
+                        'is_folder': item['mimeType'] == 'application/vnd.google-apps.folder'
+                    }
+                    _mark_workspace_export(item_details)
+                    files_and_folders.append(item_details)
+                    if item_details['is_folder']:
+                        next_frontier[item_details['id']] = item_details['path']
+            if next_frontier:
+                logger.info(f"Descending into {len(next_frontier)} subfolder(s) under '{current_path or folder_id}'")
+            frontier = next_frontier
         return files_and_folders
     except HttpError as error:
         logger.error(f"API error listing folder {folder_id} ('{current_path}'): {error.resp.status} - {error.details}")
@@ -97,20 +181,48 @@ async def list_files_in_folder_recursive(folder_id: str, credentials: Credential
         raise e
 
 
+def _mark_workspace_export(item):
+    # Google Docs/Sheets/Slides have no binary content to download directly;
+    # tag them for PDF export so the download pipeline can branch to the
+    # export endpoint instead of skipping (or fetching an empty file).
+    if not item['is_folder'] and item['mimeType'].startswith('application/vnd.google-apps.'):
+        item['export_mime'] = 'application/pdf'
+        item['name'] += '.pdf'
+        item['path'] += '.pdf'
+
+
+def _discard_task(task):
+    # Cancel a speculative task and swallow whatever it ends with, so an
+    # abandoned listing can't surface an unretrieved-exception warning.
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
 async def get_drive_items_from_link(drive_link: str, credentials: Credentials):
     file_id = get_file_id_from_link(drive_link)
     if not file_id:
         logger.warning(f"Could not extract ID from link: {drive_link}")
         return None, "Invalid Google Drive link format."
 
-    initial_metadata = await get_file_metadata(file_id, credentials)
+    # Fetch the root's metadata and speculatively start listing it as a folder
+    # at the same time: for folder links the two round-trips overlap, and for
+    # file links the listing simply comes back empty and is discarded.
+    meta_task = asyncio.create_task(get_file_metadata(file_id, credentials))
+    list_task = asyncio.create_task(list_files_in_folder_recursive(file_id, credentials, ""))
+
+    initial_metadata = await meta_task
     if not initial_metadata:
+        _discard_task(list_task)
         return None, f"Could not fetch metadata for the provided link. It might be private, invalid, or API access issue."
 
     if initial_metadata['mimeType'] == 'application/vnd.google-apps.folder':
-        logger.info(f"Link is a folder: {initial_metadata['name']}. Starting recursive listing.")
+        logger.info(f"Link is a folder: {initial_metadata['name']}. Recursive listing already underway.")
         try:
-            all_items = await list_files_in_folder_recursive(file_id, credentials, initial_metadata['name'])
+            all_items = await list_task
+            # Items were listed before the root's name was known; prefix it now
+            root_name = initial_metadata['name']
+            for item in all_items:
+                item['path'] = f"{root_name}/{item['path']}"
             # Filter out folders themselves from the final list to process, we only want files
             files_to_process = [item for item in all_items if not item['is_folder']]
             logger.info(f"Found {len(files_to_process)} files in folder '{initial_metadata['name']}' and its subdirectories.")
@@ -118,6 +230,7 @@ async def get_drive_items_from_link(drive_link: str, credentials: Credentials):
         except Exception as e:
             return None, f"Error processing folder '{initial_metadata['name']}': {e}"
     else:
+        _discard_task(list_task)
         # It's a single file
         logger.info(f"Link is a single file: {initial_metadata['name']}")
         file_details = {
@@ -128,11 +241,10 @@ async def get_drive_items_from_link(drive_link: str, credentials: Credentials):
             'path': initial_metadata['name'], # Root path for single file
             'is_folder': False
         }
-        # Google Docs, Sheets, Slides don't have a 'size' directly and need to be exported.
-        # This basic version might not handle export; it assumes direct downloadable files.
-        if "google-apps" in initial_metadata['mimeType'] and not initial_metadata.get('size'):
-            logger.warning(f"File '{initial_metadata['name']}' is a Google Workspace document. Direct download size is 0. Export might be needed (not implemented in this basic version).")
-            # For simplicity, we'll allow it to proceed, but download might fail or be an empty/link file.
-            # A more robust solution would involve service.files().export_media(...)
+        # Google Docs, Sheets, Slides have no direct download; mark them for
+        # PDF export so the transfer pipeline uses the export endpoint.
+        _mark_workspace_export(file_details)
+        if file_details.get('export_mime'):
+            logger.info(f"File '{initial_metadata['name']}' is a Google Workspace document; will export as PDF.")
 
         return [file_details], None
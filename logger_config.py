@@ -1,23 +1,43 @@
 import logging
+import logging.handlers
+import queue
 import sys
 
 def setup_logger():
     logger = logging.getLogger("GdriveToTelegramBot")
     logger.setLevel(logging.INFO)
 
-    # Create handlers
+    # Create the real output handlers. The log file rotates at 10 MB (3
+    # backups kept) instead of growing forever, and delay=True defers opening
+    # it until the first record. The MemoryHandler in front batches INFO
+    # chatter into one write per 1024 records, flushing immediately on ERROR
+    # or above so failures still hit the disk right away.
     console_handler = logging.StreamHandler(sys.stdout)
-    file_handler = logging.FileHandler("bot_activity.log")
+    file_handler = logging.handlers.RotatingFileHandler(
+        "bot_activity.log", maxBytes=10_000_000, backupCount=3, delay=True
+    )
 
     # Create formatters and add it to handlers
     log_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     console_handler.setFormatter(log_format)
     file_handler.setFormatter(log_format)
+    buffered_file_handler = logging.handlers.MemoryHandler(
+        capacity=1024, flushLevel=logging.ERROR, target=file_handler
+    )
 
-    # Add handlers to the logger
     if not logger.hasHandlers(): # Avoid adding multiple handlers if reloaded
-        logger.addHandler(console_handler)
-        logger.addHandler(file_handler)
+        # The logger itself only gets a QueueHandler: a log call is just a
+        # queue put, while formatting and the console/file writes happen on
+        # the listener's thread instead of the bot's event loop.
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+        listener = logging.handlers.QueueListener(
+            log_queue, console_handler, buffered_file_handler, respect_handler_level=True
+        )
+        listener.start()
+        # Keep a reference so the listener thread isn't garbage collected
+        logger.queue_listener = listener
 
     return logger
 
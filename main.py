@@ -1,16 +1,50 @@
 import asyncio
+import os
 import re
-from telegram import Update, constants
+import shutil
+import time
+from urllib.parse import unquote
+
+try:
+    # uvloop's selector and task scheduling are 2-4x faster than the stock
+    # loop; install() must run before the Application creates its loop.
+    import uvloop
+    uvloop.install()
+except ImportError: # Optional — the default event loop works everywhere
+    pass
+
+from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackContext
 
-from config import TELEGRAM_BOT_TOKEN, LARGE_FILE_THRESHOLD_BYTES, GOOGLE_REDIRECT_URI, ADMIN_USER_ID
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+
+from config import TELEGRAM_BOT_TOKEN, LARGE_FILE_THRESHOLD_BYTES, STREAM_MAX_BYTES, MAX_PARALLEL_FILES, MAX_DOWNLOAD_BYTES, DISK_SAFETY_MARGIN_BYTES, DOWNLOAD_DIR, LOCAL_BOT_API_URL, WEBHOOK_URL, WEBHOOK_PORT, WEBHOOK_SECRET, GOOGLE_REDIRECT_URI, ADMIN_USER_ID, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET
 from logger_config import logger
 import auth_manager
 import gdrive_handler
 import file_manager
 
-# Global flag to prevent concurrent processing for a single user
-user_processing_locks = {} # chat_id: asyncio.Lock()
+# Per-chat locks to prevent concurrent processing for a single user. A plain
+# dict grew one asyncio.Lock per chat_id forever; the TTLCache drops locks
+# idle for an hour and caps the total. An active transfer holds a strong
+# reference to its lock, so eviction can't break an in-flight request.
+user_processing_locks = TTLCache(maxsize=10_000, ttl=3600) # chat_id: asyncio.Lock()
+_locks_guard = asyncio.Lock()
+
+# Token bucket for our own outbound Telegram calls, kept under the bot-wide
+# 30 msg/s ceiling so progress edits can't starve other chats.
+TG_RATE_LIMIT = AsyncLimiter(25, 1)
+
+# Compiled once; these run against every inbound text message
+DRIVE_LINK_RE = re.compile(r'https?://drive\.google\.com/(?:file/d/|drive/folders/|open\?id=)([a-zA-Z0-9_-]+)')
+# Matches 'code=...' whether the user pasted the full redirect URL or just
+# the query fragment
+# Google percent-encodes the code in the redirect URL (e.g. code=4%2F0A...),
+# hence the % in the class; the capture is unquoted before the exchange.
+OAUTH_RESPONSE_RE = re.compile(r'(?:^|[?&])code=([A-Za-z0-9_\-/%]+)')
+# Users may also paste just the decoded code instead of the whole URL
+OAUTH_BARE_CODE_RE = re.compile(r'^[A-Za-z0-9_\-/]{20,}$')
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -51,7 +85,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def login_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.info(f"/login command received from user {user_id}")
-    auth_url = auth_manager.get_auth_url(user_id)
+    auth_url = await auth_manager.get_auth_url(user_id)
     if auth_url:
         await update.message.reply_text(
             "Please authorize this bot by visiting the following link:\n"
@@ -66,23 +100,42 @@ async def login_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.info(f"/logout command received from user {user_id}")
-    if auth_manager.delete_user_credentials(user_id):
+    if await auth_manager.delete_user_credentials(user_id):
         await update.message.reply_text("You have been successfully logged out. Your Google Drive credentials have been removed.")
     else:
         await update.message.reply_text("You were not logged in, or no credentials found to remove.")
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    credentials = auth_manager.load_user_credentials(user_id)
+    credentials = await auth_manager.load_user_credentials(user_id)
     if credentials and not credentials.expired: # Check if valid and not expired
         await update.message.reply_text(f"You are currently logged in to Google Drive. Access for large files is enabled.")
     elif credentials and credentials.expired:
         await update.message.reply_text(f"Your Google Drive session has expired. Please /login again.")
-        auth_manager.delete_user_credentials(user_id) # Clean up expired
+        await auth_manager.delete_user_credentials(user_id) # Clean up expired
     else:
         await update.message.reply_text(f"You are not logged in. Files larger than {file_manager.format_bytes(LARGE_FILE_THRESHOLD_BYTES)} will require login.")
 
 
+async def _astat_size(path):
+    # Single stat run off the event loop; returns None if the file is missing.
+    try:
+        return (await asyncio.to_thread(os.stat, path)).st_size
+    except (FileNotFoundError, TypeError):
+        return None
+
+
+# Progress message layouts, built once at import. The size string and
+# file-position suffix are formatted once per file by the caller, so filling
+# a template is the whole per-callback string cost.
+PROG_TMPL = "⏳ {stage}: '{file_name}' ({total_fmt}) {perc}%\n{file_pos}"
+FINAL_TMPL = "✅ Done: '{file_name}' ({total_fmt})\n{file_pos}"
+
+def _progress_text(stage, perc, file_name, total_fmt, file_pos, is_final):
+    tmpl = FINAL_TMPL if is_final and stage == 'Uploading' else PROG_TMPL
+    return tmpl.format(stage=stage, perc=perc, file_name=file_name, total_fmt=total_fmt, file_pos=file_pos)
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat_id = update.effective_chat.id
@@ -90,190 +143,292 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Message from {user.username} (ID: {user.id}): {message_text}")
 
     # Prevent concurrent processing by the same user
-    if chat_id not in user_processing_locks:
-        user_processing_locks[chat_id] = asyncio.Lock()
-    
-    if user_processing_locks[chat_id].locked():
+    async with _locks_guard:
+        chat_lock = user_processing_locks.get(chat_id)
+        if chat_lock is None:
+            chat_lock = asyncio.Lock()
+        # TTLCache expires a fixed ttl after insertion, not after last use;
+        # re-inserting on every hit makes the hour genuinely idle-based, so a
+        # long transfer can't have its lock evicted (and mutual exclusion
+        # silently lost) mid-flight.
+        user_processing_locks[chat_id] = chat_lock
+
+    if chat_lock.locked():
         await update.message.reply_text("I'm currently busy with your previous request. Please wait until it's complete.")
         return
 
-    async with user_processing_locks[chat_id]:
-        # Check if message is an OAuth code response
+    async with chat_lock:
+        # Check if message is an OAuth code response: either the full redirect
+        # URL (code percent-encoded) or the bare code pasted on its own.
         # A simple check, can be made more robust by checking against the 'state' param if you pass it around
-        if message_text.startswith(GOOGLE_REDIRECT_URI) or (len(message_text) > 40 and ("&code=" in message_text or "code=" in message_text.split("?")[1] if "?" in message_text else False)):
-            code = None
-            if GOOGLE_REDIRECT_URI in message_text: # Full URL pasted
-                match = re.search(r'[?&]code=([^&]+)', message_text)
-                if match:
-                    code = match.group(1)
-            elif "code=" in message_text and len(message_text) < 200: # Just the code pasted
-                code = message_text.split("code=")[-1].split("&")[0]
-            
-            if code:
-                logger.info(f"Received OAuth code from user {user.id}")
-                creds = auth_manager.exchange_code_for_credentials(user.id, code)
-                if creds:
-                    await update.message.reply_text("Successfully authenticated with Google Drive! You can now process larger files.")
-                else:
-                    await update.message.reply_text("Failed to authenticate with Google Drive. The code might be invalid or expired. Please try /login again.")
-                return
-            # else: fall through if it doesn't look like a valid code response but contains the redirect URI (e.g., user just pasted the URI without code)
+        code = None
+        code_match = OAUTH_RESPONSE_RE.search(message_text)
+        if code_match and (message_text.startswith(GOOGLE_REDIRECT_URI) or len(message_text) < 512):
+            code = unquote(code_match.group(1))
+        elif OAUTH_BARE_CODE_RE.match(message_text):
+            code = message_text
+        if code:
+            logger.info(f"Received OAuth code from user {user.id}")
+            creds = await auth_manager.exchange_code_for_credentials(user.id, code)
+            if creds:
+                await update.message.reply_text("Successfully authenticated with Google Drive! You can now process larger files.")
+            else:
+                await update.message.reply_text("Failed to authenticate with Google Drive. The code might be invalid or expired. Please try /login again.")
+            return
 
-        # Check for Google Drive links
-        drive_link_match = re.search(r'https?://drive\.google\.com/(?:file/d/|drive/folders/|open\?id=)([a-zA-Z0-9_-]+)', message_text)
+        # Check for Google Drive links; cheap substring test first so the
+        # regex only runs on messages that can possibly match
+        drive_link_match = 'drive.google.com' in message_text and DRIVE_LINK_RE.search(message_text)
         if not drive_link_match:
-            # If it's not a command, not an auth code, and not a GDrive link
-            if update.message.entities and any(e.type == constants.MessageEntityType.BOT_COMMAND for e in update.message.entities):
-                 pass # It's a command, handled by CommandHandlers
-            else:
-                await update.message.reply_text("Please send a valid Google Drive link or use a command. Type /help for instructions.")
+            # Not an auth code and not a GDrive link. Commands never reach
+            # here: the handler is registered with filters.TEXT & ~filters.COMMAND.
+            await update.message.reply_text("Please send a valid Google Drive link or use a command. Type /help for instructions.")
             return
 
         drive_link = message_text # Use the full message text as the link
         status_msg = await update.message.reply_text(f"🔗 Link received. Analyzing...")
 
-        credentials = auth_manager.load_user_credentials(user.id)
+        credentials = await auth_manager.load_user_credentials(user.id)
         
         files_to_process, error_msg = await gdrive_handler.get_drive_items_from_link(drive_link, credentials)
 
         if error_msg:
             await status_msg.edit_text(f"Error: {error_msg}")
             # If auth error (401, 403) and not logged in, suggest login
-            if ("401" in error_msg or "403" in error_msg or "Credentials" in error_msg) and not credentials:
-                 await update.message.reply_text(f"This might be a private file/folder or require higher permissions. Try /login and then send the link again.")
+            if "401" in error_msg or "403" in error_msg or "Credentials" in error_msg:
+                auth_manager.invalidate_credentials_cache(user.id) # Don't serve stale creds on retry
+                if not credentials:
+                    await update.message.reply_text(f"This might be a private file/folder or require higher permissions. Try /login and then send the link again.")
             return
         
         if not files_to_process:
             await status_msg.edit_text("No files found at the provided link or the folder is empty.")
             return
 
-        await status_msg.edit_text(f"Found {len(files_to_process)} file(s) to process. Starting sequential download and upload...")
-        
-        successful_uploads = 0
-        failed_uploads = 0
+        # Partition out over-threshold files for anonymous users up front: one
+        # aggregate skip message instead of a "Preparing..." + "Skipping" pair
+        # of API calls per unprocessable file inside the loop.
+        if not credentials:
+            skipped_large = [f for f in files_to_process if f['size'] > LARGE_FILE_THRESHOLD_BYTES]
+            if skipped_large:
+                files_to_process = [f for f in files_to_process if f['size'] <= LARGE_FILE_THRESHOLD_BYTES]
+                skip_lines = "\n".join(f['name'] for f in skipped_large[:20])
+                if len(skipped_large) > 20:
+                    skip_lines += f"\n...and {len(skipped_large) - 20} more"
+                await update.message.reply_text(
+                    f"⚠️ Skipping {len(skipped_large)} file(s) over "
+                    f"{file_manager.format_bytes(LARGE_FILE_THRESHOLD_BYTES)} (login required — use /login "
+                    f"and resend the link):\n{skip_lines}"
+                )
+            if not files_to_process:
+                await status_msg.edit_text("All files at this link require login to transfer. Use /login and resend the link.")
+                return
 
-        for index, file_info in enumerate(files_to_process):
+        # Group small files into sendMediaGroup albums: one API call and one
+        # rate-limit token cover up to 10 of them. Workspace exports stay on
+        # the per-file path (their exported size is unknown up front), as does
+        # a leftover singleton batch.
+        album_eligible = [f for f in files_to_process
+                          if 0 < f['size'] <= file_manager.ALBUM_MAX_FILE_BYTES and not f.get('export_mime')]
+        album_batches = []
+        if len(album_eligible) >= 2:
+            eligible_ids = {id(f) for f in album_eligible}
+            files_to_process = [f for f in files_to_process if id(f) not in eligible_ids]
+            album_batches = [album_eligible[i:i + file_manager.ALBUM_MAX_FILES]
+                             for i in range(0, len(album_eligible), file_manager.ALBUM_MAX_FILES)]
+            if len(album_batches[-1]) == 1: # A lone file gains nothing from album framing
+                files_to_process.append(album_batches.pop()[0])
+
+        album_file_count = sum(len(b) for b in album_batches)
+        total_files = len(files_to_process) + album_file_count
+        found_note = f"Found {total_files} file(s) to process"
+        if album_batches:
+            found_note += f" ({album_file_count} small file(s) grouped into {len(album_batches)} album(s))"
+        await status_msg.edit_text(f"{found_note}. Starting downloads and uploads...")
+
+        solo_total = len(files_to_process)
+        # Up to MAX_PARALLEL_FILES files in flight at once, so file N+1's
+        # download overlaps file N's upload; file_manager's own semaphores
+        # cap the underlying transfer legs.
+        file_sem = asyncio.Semaphore(MAX_PARALLEL_FILES)
+
+        async def process_one(index, file_info):
+            # Transfers one file; returns True on a successful upload.
             file_name = file_info['name']
             file_id = file_info['id']
             file_size = file_info['size']
             file_path_in_drive = file_info['path']
 
-            progress_message_text = lambda stage, perc, final_fn, total_s, is_fin: \
-                f"{'✅ Done: ' if is_fin and stage=='Uploading' else ('⏳ ' + stage + ': ')} '{final_fn}' ({file_manager.format_bytes(total_s)})" + \
-                (f" {perc}%" if not (is_fin and stage=='Uploading') else "") + \
-                f"\n(File {index+1}/{len(files_to_process)}: {file_path_in_drive})"
+            # Formatted once here instead of on every progress callback
+            total_fmt = file_manager.format_bytes(file_size)
+            file_pos = f"(File {index+1}/{solo_total}: {file_path_in_drive})"
+
+            async with file_sem:
+                async with TG_RATE_LIMIT:
+                    current_op_msg = await context.bot.send_message(chat_id, f"Preparing to process: '{file_name}'...")
+
+                # Throttle state shared by both updaters: at most one edit per
+                # 2 s or 5% step, so a chunk-cadence callback can't flood the
+                # API with edits for a single file.
+                # last_text dedupes repeated edits locally: Message.text is a
+                # snapshot from send_message and never reflects edit_text, so
+                # comparing against it always saw the original text.
+                last_edit = {'ts': 0.0, 'pct': -100, 'last_text': None}
+
+                def _edit_due(percentage, is_final):
+                    now = time.monotonic()
+                    if is_final or now - last_edit['ts'] > 2.0 or abs(percentage - last_edit['pct']) >= 5:
+                        last_edit['ts'] = now
+                        last_edit['pct'] = percentage
+                        return True
+                    return False
+
+                async def download_progress_updater(current_file_name, percentage, total_size, is_final=False):
+                    if not _edit_due(percentage, is_final):
+                        return
+                    new_text = _progress_text("Downloading", percentage, current_file_name, total_fmt, file_pos, is_final)
+                    if new_text == last_edit['last_text']: # Only edit if text changed
+                        return
+                    try:
+                        async with TG_RATE_LIMIT:
+                            await current_op_msg.edit_text(new_text)
+                        last_edit['last_text'] = new_text
+                    except Exception as e: # e.g., message not modified
+                        logger.debug(f"Minor error updating download progress: {e}")
+
+                async def upload_progress_updater(current_file_name, percentage, total_size, is_final=False):
+                    if not _edit_due(percentage, is_final):
+                        return
+                    new_text = _progress_text("Uploading", percentage, current_file_name, total_fmt, file_pos, is_final)
+                    if new_text == last_edit['last_text']:
+                        return
+                    try:
+                        async with TG_RATE_LIMIT:
+                            await current_op_msg.edit_text(new_text)
+                        last_edit['last_text'] = new_text
+                    except Exception as e:
+                        logger.debug(f"Minor error updating upload progress: {e}")
 
-            current_op_msg = await context.bot.send_message(chat_id, f"Preparing to process: '{file_name}'...")
-
-            async def download_progress_updater(current_file_name, percentage, total_size, is_final=False):
-                nonlocal current_op_msg
-                new_text = progress_message_text("Downloading", percentage, current_file_name, total_size, is_final)
                 try:
-                    if current_op_msg.text != new_text: # Only edit if text changed
-                        await current_op_msg.edit_text(new_text)
-                except Exception as e: # e.g., message not modified
-                    logger.debug(f"Minor error updating download progress: {e}")
-            
-            async def upload_progress_updater(current_file_name, percentage, total_size, is_final=False):
-                nonlocal current_op_msg
-                new_text = progress_message_text("Uploading", percentage, current_file_name, total_size, is_final)
+                    # Google Workspace docs carry an export_mime and come back as PDF
+                    export_mime = file_info.get('export_mime')
+
+                    # Caption includes the full path within the Drive folder structure
+                    upload_caption = f"{file_path_in_drive} ({file_manager.format_bytes(file_size)})"
+                    if len(upload_caption) > 1024: # Telegram caption limit
+                        upload_caption = f"{file_name} ({file_manager.format_bytes(file_size)}) (Path too long)"
+
+                    if file_size <= STREAM_MAX_BYTES:
+                        # Fused path: stream Drive chunks straight into the Telegram
+                        # upload without staging the file in DOWNLOAD_DIR.
+                        return await file_manager.stream_gdrive_to_telegram(
+                            context.bot, chat_id, file_id, file_name, file_size, credentials,
+                            upload_caption, download_progress_updater, upload_progress_updater,
+                            export_mime=export_mime
+                        )
+
+                    # Staged path for files too large to hold in memory.
+                    # Reject up front anything that would blow the per-file cap
+                    # or leave the disk below the safety margin mid-download.
+                    free_disk = (await asyncio.to_thread(shutil.disk_usage, DOWNLOAD_DIR)).free
+                    if file_size > MAX_DOWNLOAD_BYTES or file_size > free_disk - DISK_SAFETY_MARGIN_BYTES:
+                        logger.warning(
+                            f"Rejecting staged download of '{file_name}' ({file_manager.format_bytes(file_size)}): "
+                            f"limit {file_manager.format_bytes(MAX_DOWNLOAD_BYTES)}, free disk {file_manager.format_bytes(free_disk)}"
+                        )
+                        await current_op_msg.edit_text(
+                            f"⚠️ '{file_name}' ({file_manager.format_bytes(file_size)}) rejected: exceeds the "
+                            f"{file_manager.format_bytes(MAX_DOWNLOAD_BYTES)} download limit or available disk space. Skipping."
+                        )
+                        return False
+
+                    # staged_download guarantees the file is unlinked however
+                    # this block exits, so nothing can leak into DOWNLOAD_DIR.
+                    async with file_manager.staged_download(
+                        file_id, file_name, file_size, credentials, download_progress_updater,
+                        export_mime=export_mime
+                    ) as downloaded_file_path:
+                        # One async stat covers both the missing-file and the
+                        # empty-file checks that used to take three blocking
+                        # exists/getsize syscalls on the event loop.
+                        # If download truly failed, it would have raised an exception caught below.
+                        # If file_size was 0 (like a GDoc link file), and it downloaded as 0, it's "successful" in that sense.
+                        staged_size = await _astat_size(downloaded_file_path)
+                        if file_size > 0:
+                            if staged_size is None: # A real failure to get the file
+                                logger.error(f"Download of {file_name} reported success but file not found. Path: {downloaded_file_path}")
+                                await current_op_msg.edit_text(f"❌ Download of '{file_name}' seemed to complete but the file is missing or empty. Skipping.")
+                                return False
+                            elif staged_size == 0: # Downloaded an empty file when original had size
+                                logger.warning(f"Downloaded file '{file_name}' is empty, but original size was {file_manager.format_bytes(file_size)}. Skipping upload of empty file.")
+                                await current_op_msg.edit_text(f"⚠️ Downloaded file '{file_name}' is empty. Original size was {file_manager.format_bytes(file_size)}. Skipping upload.")
+                                return False
+
+                        return await file_manager.upload_to_telegram(
+                            context.bot, chat_id, downloaded_file_path, upload_caption, file_name, upload_progress_updater
+                        )
+
+                except ConnectionError as e: # Specific for GDrive API issues during download usually
+                    logger.error(f"A Google Drive connection error occurred processing {file_name}: {e}")
+                    await current_op_msg.edit_text(f"❌ GDrive Connection Error for '{file_name}': {e}. Skipping.")
+                    return False
+                except IOError as e: # Specific for local file system issues during download
+                    logger.error(f"A file system error occurred processing {file_name}: {e}")
+                    await current_op_msg.edit_text(f"❌ File System Error for '{file_name}': {e}. Skipping.")
+                    return False
+                except Exception as e:
+                    logger.error(f"An unexpected error occurred processing file {file_name} (ID: {file_id}): {e}", exc_info=True)
+                    await current_op_msg.edit_text(f"❌ Unexpected Error for '{file_name}': {e}. Skipping.")
+                    return False
+
+        async def process_album(batch):
+            # Sends one album; returns how many of its files went through.
+            async with file_sem:
+                async with TG_RATE_LIMIT:
+                    album_msg = await context.bot.send_message(chat_id, f"Uploading album of {len(batch)} small file(s)...")
                 try:
-                     if current_op_msg.text != new_text:
-                        await current_op_msg.edit_text(new_text)
+                    await file_manager.send_album_from_gdrive(context.bot, chat_id, batch, credentials)
+                    async with TG_RATE_LIMIT:
+                        await album_msg.edit_text(f"✅ Sent album of {len(batch)} file(s).")
+                    return len(batch)
                 except Exception as e:
-                    logger.debug(f"Minor error updating upload progress: {e}")
-
-            try:
-                # Check for large file and login status
-                if file_size > LARGE_FILE_THRESHOLD_BYTES and not credentials:
-                    await current_op_msg.edit_text(
-                        f"⚠️ File '{file_name}' ({file_manager.format_bytes(file_size)}) exceeds "
-                        f"{file_manager.format_bytes(LARGE_FILE_THRESHOLD_BYTES)} and requires login. "
-                        f"Please use /login and then resend the original Drive link.\nSkipping this file."
-                    )
-                    failed_uploads += 1
-                    continue
-
-                # --- Download ---
-                if "google-apps" in file_info['mimeType'] and not file_size: # Check for GDocs
-                    # This example doesn't implement export for GDocs, Sheets, etc.
-                    # They would need service.files().export_media(...)
-                    await current_op_msg.edit_text(f"ℹ️ File '{file_name}' is a Google Workspace document type. "
-                                               "Direct download might not be the intended file (e.g., it might be a link or small metadata file). "
-                                               "Full export for these types is not supported in this version. Attempting standard download. Skipped if empty.")
-                    # For simplicity, try to download; if it's 0 bytes or tiny, it'll likely be handled. Or skip here.
-                    # For now, let it attempt download. If it's a real issue, user will see.
-                
-                downloaded_file_path = await file_manager.download_gdrive_file(
-                    file_id, file_name, file_size, credentials, download_progress_updater
-                )
+                    logger.error(f"Failed to send album of {len(batch)} file(s): {e}", exc_info=True)
+                    await album_msg.edit_text(f"❌ Failed to send album of {len(batch)} file(s): {e}. Skipping.")
+                    return 0
 
-                if not downloaded_file_path or not os.path.exists(downloaded_file_path) or os.path.getsize(downloaded_file_path) == 0 and file_size > 0 :
-                    # Handle cases where download_gdrive_file might return None or empty file for non-error cases (e.g. already exists and skipped)
-                    # If download truly failed, it would have raised an exception caught below.
-                    # If file_size was 0 (like a GDoc link file), and it downloaded as 0, it's "successful" in that sense.
-                    if not os.path.exists(downloaded_file_path) and file_size > 0: # Ensure it's a real failure to get the file
-                        logger.error(f"Download of {file_name} reported success but file not found or empty. Path: {downloaded_file_path}")
-                        await current_op_msg.edit_text(f"❌ Download of '{file_name}' seemed to complete but the file is missing or empty. Skipping.")
-                        failed_uploads +=1
-                        continue
-                    elif os.path.exists(downloaded_file_path) and os.path.getsize(downloaded_file_path) == 0 and file_size > 0: # Downloaded an empty file when original had size
-                        logger.warning(f"Downloaded file '{file_name}' is empty, but original size was {file_manager.format_bytes(file_size)}. Skipping upload of empty file.")
-                        await current_op_msg.edit_text(f"⚠️ Downloaded file '{file_name}' is empty. Original size was {file_manager.format_bytes(file_size)}. Skipping upload.")
-                        os.remove(downloaded_file_path) # Clean up empty file
-                        failed_uploads += 1
-                        continue
-
-
-                # --- Upload ---
-                # Caption includes the full path within the Drive folder structure
-                upload_caption = f"{file_path_in_drive} ({file_manager.format_bytes(file_size)})"
-                if len(upload_caption) > 1024: # Telegram caption limit
-                    upload_caption = f"{file_name} ({file_manager.format_bytes(file_size)}) (Path too long)"
-
-
-                upload_success = await file_manager.upload_to_telegram(
-                    context.bot, chat_id, downloaded_file_path, upload_caption, file_name, upload_progress_updater
-                )
-                
-                if upload_success:
-                    successful_uploads += 1
-                    # The final "Uploaded" message is handled by the progress updater with is_final=True
-                    # We can delete current_op_msg as it's served its purpose for this file.
-                    # Or let the next file's "Preparing" message overwrite it implicitly if not deleted.
-                    # await current_op_msg.delete() # Optional: delete the progress message
-                else:
-                    failed_uploads += 1
-                    # Error message already sent by upload_to_telegram
-                    # await current_op_msg.edit_text(f"❌ Failed to upload '{file_name}'. See previous error. Skipping.") # This would overwrite specific error.
-
-            except ConnectionError as e: # Specific for GDrive API issues during download usually
-                logger.error(f"A Google Drive connection error occurred processing {file_name}: {e}")
-                await current_op_msg.edit_text(f"❌ GDrive Connection Error for '{file_name}': {e}. Skipping.")
-                failed_uploads += 1
-            except IOError as e: # Specific for local file system issues during download
-                logger.error(f"A file system error occurred processing {file_name}: {e}")
-                await current_op_msg.edit_text(f"❌ File System Error for '{file_name}': {e}. Skipping.")
-                failed_uploads += 1
-            except Exception as e:
-                logger.error(f"An unexpected error occurred processing file {file_name} (ID: {file_id}): {e}", exc_info=True)
-                await current_op_msg.edit_text(f"❌ Unexpected Error for '{file_name}': {e}. Skipping.")
-                failed_uploads += 1
-            
-            await asyncio.sleep(1) # Small delay between files
+        file_tasks = [process_one(i, f) for i, f in enumerate(files_to_process)]
+        album_tasks = [process_album(batch) for batch in album_batches]
+        results = await asyncio.gather(*file_tasks, *album_tasks)
+        successful_uploads = sum(1 for ok in results[:len(file_tasks)] if ok) + sum(results[len(file_tasks):])
+        failed_uploads = total_files - successful_uploads
 
         final_summary = f"\n--- Processing Complete --- \n✅ Successfully uploaded: {successful_uploads} file(s)\n❌ Failed/Skipped: {failed_uploads} file(s)"
-        await context.bot.send_message(chat_id, final_summary)
+        async with TG_RATE_LIMIT:
+            await context.bot.send_message(chat_id, final_summary)
     # Lock is released when exiting 'async with'
 
+async def post_init(application: Application):
+    # Runs inside the bot's event loop once it's up; start background tasks here.
+    auth_manager.start_flow_reaper()
+
 def main():
-    if not TELEGRAM_BOT_TOKEN or not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
+    if not all([TELEGRAM_BOT_TOKEN, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET]):
         logger.critical("CRITICAL: Telegram Bot Token or Google API credentials are not set in .env file. Exiting.")
         return
 
     logger.info("Bot starting...")
     
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init)
+    if LOCAL_BOT_API_URL:
+        # Self-hosted telegram-bot-api sidecar (run with --local): lifts the
+        # upload cap from 50 MB to 2 GB and accepts local file paths, so
+        # staged uploads skip one full network hop.
+        logger.info(f"Using local Bot API server at {LOCAL_BOT_API_URL}")
+        builder = builder \
+            .base_url(f"{LOCAL_BOT_API_URL}/bot") \
+            .base_file_url(f"{LOCAL_BOT_API_URL}/file/bot") \
+            .local_mode(True)
+    application = builder.build()
 
     # Command Handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -285,8 +440,21 @@ def main():
     # Message Handler for Google Drive links and OAuth codes
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
-    logger.info("Bot polling...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us, so there is no polling round-trip
+        # latency and no idle getUpdates requests between messages. The bot
+        # token doubles as the (unguessable) URL path.
+        logger.info(f"Bot listening for webhooks on port {WEBHOOK_PORT}...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        logger.info("Bot polling...")
+        application.run_polling()
 
 if __name__ == '__main__':
     main()